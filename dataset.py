@@ -1,43 +1,186 @@
-from torch.utils.data import IterableDataset
+import mmap
+import os
+import random
+import stat
+from array import array
+from contextlib import contextmanager
 
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
 
-def blocks(files, size=65536):
-    while True:
-        b = files.read(size)
-        if not b:
-            break
-        yield b
 
+def count_lines(input_path: str, chunk_size: int = 64 << 20) -> int:
+    fd = os.open(input_path, os.O_RDONLY)
+    try:
+        file_stat = os.fstat(fd)
+        if stat.S_ISREG(file_stat.st_mode) and file_stat.st_size > 0:
+            with mmap.mmap(fd, file_stat.st_size, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                return sum(
+                    mm[start : start + chunk_size].count(b"\n")
+                    for start in range(0, file_stat.st_size, chunk_size)
+                )
 
-def count_lines(input_path: str) -> int:
-    with open(input_path, "r", encoding="utf8") as f:
-        return sum(bl.count("\n") for bl in blocks(f))
+        # Empty files, pipes and other special files can't be mapped, count
+        # the newlines while reading the raw bytes in 1 MiB chunks instead.
+        num_lines = 0
+        while True:
+            chunk = os.read(fd, 1 << 20)
+            if not chunk:
+                return num_lines
+            num_lines += chunk.count(b"\n")
+    finally:
+        os.close(fd)
 
 
 class DatasetReader(IterableDataset):
-    def __init__(self, filename, tokenizer, max_length=128):
+    def __init__(
+        self,
+        filename,
+        tokenizer,
+        max_length=128,
+        max_tokens_per_batch=1024,
+        padding=True,
+        pad_to_multiple_of=8,
+        num_processes=1,
+        process_index=0,
+        batches_per_window=64,
+    ):
         self.filename = filename
         self.tokenizer = tokenizer
         self.max_length = max_length
-        self.current_line = 0
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.padding = padding
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.num_processes = num_processes
+        self.process_index = process_index
+        self.batches_per_window = batches_per_window
+        self.line_offsets = None
+        self.empty_mask = None
 
-    def preprocess(self, text: str):
-        self.current_line += 1
-        text = text.rstrip().strip()
+    def preprocess(self, text: str, line_number: int):
+        text = text.strip()
         if len(text) == 0:
-            print(f"Warning: empty sentence at line {self.current_line}")
-        return self.tokenizer(
-            text,
-            padding=False,
-            truncation=True,
-            max_length=self.max_length,
-            return_tensors=None,
+            print(f"Warning: empty sentence at line {line_number}")
+        return text
+
+    def padded_length(self, length: int) -> int:
+        if self.padding == "max_length":
+            return self.max_length
+        multiple = self.pad_to_multiple_of or 1
+        return -(-length // multiple) * multiple
+
+    def collate(self, input_ids, indices):
+        # Every process takes an equally sized share of the batch, shorter
+        # shares are filled with copies of the last sentence marked with index -1.
+        share = -(-len(input_ids) // self.num_processes)
+        start = self.process_index * share
+        num_fill = share - len(input_ids[start : start + share])
+        input_ids = input_ids[start : start + share] + [input_ids[-1]] * num_fill
+        indices = indices[start : start + share] + [-1] * num_fill
+
+        batch = dict(
+            self.tokenizer.pad(
+                {"input_ids": input_ids},
+                padding=self.padding,
+                max_length=self.max_length if self.padding == "max_length" else None,
+                pad_to_multiple_of=self.pad_to_multiple_of,
+                return_tensors="pt",
+            )
         )
+        batch["indices"] = torch.tensor(indices)
+        return batch
+
+    def load(self):
+        # Only the byte offsets of the lines are kept, so the DataLoader workers
+        # and the retries of the batch size finder don't scan the file again.
+        # The text itself is read from a memory map of the file, whose pages are
+        # shared by all the processes through the page cache.
+        if self.line_offsets is None:
+            offsets = array("q", [0])
+            empty = array("b")
+            # Binary mode skips the universal newline translation, a "\r" left
+            # by "\r\n" line endings is removed by strip().
+            with open(self.filename, "rb", buffering=1 << 20) as file_itr:
+                for line_number, line in enumerate(file_itr, start=1):
+                    offsets.append(offsets[-1] + len(line))
+                    empty.append(
+                        not self.preprocess(line.decode("utf-8"), line_number)
+                    )
+            self.line_offsets = np.array(offsets, dtype=np.int64)
+            self.empty_mask = np.array(empty, dtype=np.bool_)
+        return self.line_offsets
+
+    @contextmanager
+    def open_mmap(self):
+        """
+        Memory-maps the file for read_line, empty files can't be mapped and
+        give None.
+        """
+        with open(self.filename, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                yield None
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+
+    def read_line(self, mm, index: int) -> str:
+        start, end = self.line_offsets[index], self.line_offsets[index + 1]
+        return mm[start:end].decode("utf-8").strip()
+
+    def empty_lines(self):
+        self.load()
+        return np.flatnonzero(self.empty_mask).tolist()
 
     def __iter__(self):
-        file_itr = open(self.filename, "r")
-        mapped_itr = map(self.preprocess, file_itr)
-        return mapped_itr
+        self.load()
+        # With several DataLoader workers every worker reads a strided share of
+        # the lines, the line indices let the writer restore the file order.
+        worker_info = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        )
+        # Empty lines are not tokenized nor translated, see empty_lines.
+        worker_indices = (
+            np.flatnonzero(~self.empty_mask[worker_id::num_workers]) * num_workers
+            + worker_id
+        ).tolist()
+        # A window holds as many batches as we would get if every sentence
+        # had the maximum length.
+        window_size = self.batches_per_window * max(
+            1, self.max_tokens_per_batch // self.max_length
+        )
+        with self.open_mmap() as mm:
+            for window_index, start in enumerate(
+                range(0, len(worker_indices), window_size)
+            ):
+                indices = worker_indices[start : start + window_size]
+                input_ids = self.tokenizer(
+                    [self.read_line(mm, index) for index in indices],
+                    truncation=True,
+                    max_length=self.max_length,
+                )["input_ids"]
+
+                # Batch sentences of similar length together to minimize padding,
+                # and add sentences to a batch while it fits in the token budget.
+                # The batch order is shuffled with a seed shared by all processes.
+                order = sorted(range(len(indices)), key=lambda i: len(input_ids[i]))
+                batches = [[]]
+                for i in order:
+                    length = self.padded_length(len(input_ids[i]))
+                    if (
+                        batches[-1]
+                        and (len(batches[-1]) + 1) * length > self.max_tokens_per_batch
+                    ):
+                        batches.append([])
+                    batches[-1].append(i)
+                random.Random(window_index).shuffle(batches)
+                for batch in batches:
+                    yield self.collate(
+                        [input_ids[i] for i in batch], [indices[i] for i in batch]
+                    )
 
 
 class ParallelTextReader(IterableDataset):
@@ -51,23 +194,26 @@ class ParallelTextReader(IterableDataset):
             f"{pref_filename_lines} vs {gold_path_lines}"
         )
         self.num_sentences = gold_path_lines
-        self.current_line = 0
 
-    def preprocess(self, pred: str, gold: str):
-        self.current_line += 1
-        pred = pred.rstrip().strip()
-        gold = gold.rstrip().strip()
+    def preprocess(self, pred: str, gold: str, line_number: int):
+        pred = pred.strip()
+        gold = gold.strip()
         if len(pred) == 0:
-            print(f"Warning: Pred empty sentence at line {self.current_line}")
+            print(f"Warning: Pred empty sentence at line {line_number}")
         if len(gold) == 0:
-            print(f"Warning: Gold empty sentence at line {self.current_line}")
+            print(f"Warning: Gold empty sentence at line {line_number}")
         return pred, [gold]
 
     def __iter__(self):
-        pred_itr = open(self.pred_path, "r")
-        gold_itr = open(self.gold_path, "r")
-        mapped_itr = map(self.preprocess, pred_itr, gold_itr)
-        return mapped_itr
+        with open(self.pred_path, "rb", buffering=1 << 20) as pred_itr, open(
+            self.gold_path, "rb", buffering=1 << 20
+        ) as gold_itr:
+            for line_number, (pred, gold) in enumerate(
+                zip(pred_itr, gold_itr), start=1
+            ):
+                yield self.preprocess(
+                    pred.decode("utf-8"), gold.decode("utf-8"), line_number
+                )
 
     def __len__(self):
         return self.num_sentences
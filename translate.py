@@ -1,50 +1,396 @@
 from transformers import (
     M2M100ForConditionalGeneration,
-    M2M100Tokenizer,
+    AutoTokenizer,
+    BitsAndBytesConfig,
     PreTrainedTokenizerBase,
-    DataCollatorForSeq2Seq,
 )
 from tqdm import tqdm
 import argparse
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
 from dataset import DatasetReader, count_lines
 import os
+import heapq
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashlib import blake2b
 from accelerate import Accelerator, DistributedType
 from accelerate.memory_utils import find_executable_batch_size
 
 
+class ShardedDecoder:
+    """
+    Decodes generated tokens by splitting them across several tokenizer copies
+    running in a thread pool. Only fast tokenizers release the GIL while
+    decoding, slow tokenizers get a single shard.
+    """
+
+    def __init__(self, tokenizers: list):
+        self.tokenizers = tokenizers
+        self.executor = ThreadPoolExecutor(max_workers=len(tokenizers))
+
+    def __call__(self, generated_tokens: np.ndarray) -> list:
+        shards = np.array_split(generated_tokens, len(self.tokenizers))
+        futures = [
+            self.executor.submit(
+                tokenizer.batch_decode, shard, skip_special_tokens=True
+            )
+            for tokenizer, shard in zip(self.tokenizers, shards)
+            if len(shard) > 0
+        ]
+        return [text for future in futures for text in future.result()]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class OrderedWriter:
+    """
+    Writes translated lines to the output file in their original line order,
+    lines can be added in any order.
+    """
+
+    def __init__(self, output_file, flush_every: int = 64):
+        self.output_file = output_file
+        self.flush_every = flush_every
+        self.next_index = 0
+        self.pending = []
+        self.num_batches = 0
+
+    def add(self, indices, lines):
+        for index, line in zip(indices, lines):
+            heapq.heappush(self.pending, (index, line))
+
+        ready = []
+        while self.pending and self.pending[0][0] == self.next_index + len(ready):
+            ready.append(heapq.heappop(self.pending)[1])
+        if ready:
+            # One write per batch, lines are separated but not terminated by "\n".
+            chunk = "\n".join(ready)
+            self.output_file.write(chunk if self.next_index == 0 else "\n" + chunk)
+            self.next_index += len(ready)
+
+        self.num_batches += 1
+        if self.num_batches % self.flush_every == 0:
+            self.output_file.flush()
+
+
+class AsyncPostprocessor:
+    """
+    Copies the generated tokens to pinned host memory on a side CUDA stream and
+    decodes and writes them in a background thread, which overlaps the CPU work
+    with the next call to generate.
+    """
+
+    def __init__(self, decoder, writer, pbar, device, max_numel: int = 0):
+        self.decoder = decoder
+        self.writer = writer
+        self.pbar = pbar
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.copy_stream = (
+            torch.cuda.Stream(device=device) if device.type == "cuda" else None
+        )
+        # Double buffering, a staging buffer is reused once its batch is written.
+        # They are allocated upfront for the largest expected batch.
+        self.staging_buffers = [
+            (
+                torch.empty(max_numel, dtype=torch.long, pin_memory=True)
+                if self.copy_stream is not None and max_numel > 0
+                else None
+            )
+            for _ in range(2)
+        ]
+        self.futures = [None, None]
+        self.step = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            if future is not None:
+                future.result()
+
+    def staging_buffer(self, slot, generated_tokens):
+        numel = generated_tokens.numel()
+        buffer = self.staging_buffers[slot]
+        if buffer is None or buffer.numel() < numel:
+            buffer = torch.empty(numel, dtype=generated_tokens.dtype, pin_memory=True)
+            self.staging_buffers[slot] = buffer
+        return buffer[:numel].view(generated_tokens.shape)
+
+    def submit(self, generated_tokens, indices, merge=None):
+        slot = self.step % 2
+        self.step += 1
+        if self.futures[slot] is not None:
+            self.futures[slot].result()
+
+        if generated_tokens is None:
+            host_tokens, copy_done = None, None
+        elif self.copy_stream is None or not generated_tokens.is_cuda:
+            host_tokens, copy_done = generated_tokens.cpu(), None
+        else:
+            host_tokens = self.staging_buffer(slot, generated_tokens)
+            self.copy_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.copy_stream):
+                host_tokens.copy_(generated_tokens, non_blocking=True)
+                copy_done = torch.cuda.Event()
+                copy_done.record()
+            generated_tokens.record_stream(self.copy_stream)
+
+        self.futures[slot] = self.executor.submit(
+            self.process, host_tokens, copy_done, indices, merge
+        )
+
+    def process(self, host_tokens, copy_done, indices, merge):
+        if copy_done is not None:
+            copy_done.synchronize()
+        generated_tokens = host_tokens.numpy() if host_tokens is not None else None
+        if merge is not None:
+            generated_tokens = merge(generated_tokens)
+        keep = indices >= 0
+        tgt_text = self.decoder(generated_tokens[keep])
+        self.writer.add(indices[keep], tgt_text)
+        self.pbar.update(len(tgt_text))
+
+
+class TranslationCache:
+    """
+    LRU cache from the hash of a sentence to its generated tokens, so repeated
+    sentences are only translated once.
+    """
+
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        # Entries are looked up in the main loop and added by the postprocessor.
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def keys(dataset: DatasetReader, mm, indices) -> list:
+        """
+        Returns the key of every line, or None for the rows that fill a batch.
+        """
+        return [
+            blake2b(
+                dataset.read_line(mm, index).encode("utf-8"), digest_size=16
+            ).digest()
+            if index >= 0
+            else None
+            for index in indices.tolist()
+        ]
+
+    def lookup(self, keys: list) -> dict:
+        """
+        Returns the cached tokens of the rows found in the cache.
+        """
+        cached = {}
+        with self.lock:
+            for row, key in enumerate(keys):
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    cached[row] = self.entries[key]
+        return cached
+
+    def store(self, keys: list, generated_tokens: np.ndarray, pad_token_id: int):
+        with self.lock:
+            for key, tokens in zip(keys, generated_tokens):
+                if key is None:
+                    continue
+                # Copy without the trailing padding, the array may be a view of a
+                # staging buffer that will be reused.
+                length = len(tokens) - int(np.argmax(tokens[::-1] != pad_token_id))
+                self.entries[key] = tokens[:length].copy()
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return generated_tokens
+
+    def merge(self, keys, cached, generated_tokens, pad_token_id: int):
+        """
+        Stores the generated rows and fills in the cached ones, in batch order.
+        """
+        if generated_tokens is not None:
+            self.store(
+                [key for row, key in enumerate(keys) if row not in cached],
+                generated_tokens,
+                pad_token_id,
+            )
+        if not cached:
+            return generated_tokens
+
+        generated_rows = iter(generated_tokens if generated_tokens is not None else [])
+        rows = [
+            cached[row] if row in cached else next(generated_rows)
+            for row in range(len(keys))
+        ]
+        merged = np.full(
+            (len(rows), max(len(tokens) for tokens in rows)),
+            pad_token_id,
+            dtype=np.int64,
+        )
+        for row, tokens in enumerate(rows):
+            merged[row, : len(tokens)] = tokens
+        return merged
+
+
+def fill_cached_rows(
+    generated_tokens: torch.Tensor,
+    cached: dict,
+    num_rows: int,
+    pad_token_id: int,
+    device: torch.device,
+) -> torch.Tensor:
+    """
+    Puts the cached rows back in between the generated ones on the device. Only
+    the cached rows are copied to the device, the generated tokens never leave it.
+    """
+    length = max(len(tokens) for tokens in cached.values())
+    if generated_tokens is not None:
+        length = max(length, generated_tokens.shape[1])
+    merged = torch.full((num_rows, length), pad_token_id, dtype=torch.long)
+    is_generated = torch.ones((num_rows, 1), dtype=torch.bool)
+    for row, tokens in cached.items():
+        merged[row, : len(tokens)] = torch.from_numpy(tokens)
+        is_generated[row] = False
+    if device.type == "cuda":
+        merged, is_generated = merged.pin_memory(), is_generated.pin_memory()
+    merged = merged.to(device, non_blocking=True)
+    is_generated = is_generated.to(device, non_blocking=True)
+
+    if generated_tokens is not None:
+        generated_tokens = torch.nn.functional.pad(
+            generated_tokens,
+            (0, length - generated_tokens.shape[1]),
+            value=pad_token_id,
+        )
+        # Fills the generated rows in order, without synchronizing with the host.
+        merged.masked_scatter_(is_generated.expand_as(merged), generated_tokens)
+    return merged
+
+
+def load_ctranslate2_model(
+    model_name: str,
+    model_dir: str,
+    precision: str,
+    device: torch.device,
+):
+    """
+    Loads a CTranslate2 translator, converting the model the first time.
+    """
+    import ctranslate2
+
+    if not os.path.exists(os.path.join(model_dir, "model.bin")):
+        print(f"Converting {model_name} to CTranslate2 in {model_dir}...")
+        ctranslate2.converters.TransformersConverter(model_name).convert(model_dir)
+
+    compute_types = {
+        "32": "float32",
+        "fp16": "float16",
+        "bf16": "bfloat16",
+        "int8": "int8_float16" if device.type == "cuda" else "int8",
+    }
+    if precision not in compute_types:
+        raise ValueError(
+            f"Precision not supported. Supported values: {', '.join(compute_types)}"
+        )
+
+    return ctranslate2.Translator(
+        model_dir,
+        device="cuda" if device.type == "cuda" else "cpu",
+        device_index=device.index or 0,
+        compute_type=compute_types[precision],
+    )
+
+
+def ctranslate2_generate(
+    translator,
+    tokenizer: PreTrainedTokenizerBase,
+    batch: dict,
+    target_token: str,
+    gen_kwargs: dict,
+) -> torch.Tensor:
+    """
+    Translates a batch with CTranslate2, which runs the whole beam search in C++.
+    Returns the generated token ids padded like the output of generate.
+    """
+    source = [
+        tokenizer.convert_ids_to_tokens(input_ids[attention_mask.bool()].tolist())
+        for input_ids, attention_mask in zip(
+            batch["input_ids"], batch["attention_mask"]
+        )
+    ]
+    try:
+        results = translator.translate_batch(
+            source,
+            target_prefix=[[target_token]] * len(source),
+            beam_size=gen_kwargs["num_beams"],
+            max_decoding_length=gen_kwargs["max_length"],
+        )
+    except RuntimeError as e:
+        # CTranslate2 reports "CUDA failed with error out of memory", which
+        # find_executable_batch_size does not recognise as an OOM.
+        if "out of memory" in str(e):
+            raise RuntimeError(f"CUDA out of memory. {e}") from e
+        raise
+
+    # The hypotheses start with the target language token.
+    hypotheses = [
+        tokenizer.convert_tokens_to_ids(r.hypotheses[0][1:]) for r in results
+    ]
+    generated_tokens = torch.full(
+        (len(hypotheses), max(1, max(len(ids) for ids in hypotheses))),
+        tokenizer.pad_token_id,
+        dtype=torch.long,
+    )
+    for row, ids in enumerate(hypotheses):
+        generated_tokens[row, : len(ids)] = torch.tensor(ids, dtype=torch.long)
+    return generated_tokens
+
+
+def compile_model(model: M2M100ForConditionalGeneration):
+    """
+    Fuses the attention kernels and compiles the forward pass with torch.compile.
+    """
+    # Recent versions of transformers already run the M2M100 attention through
+    # scaled_dot_product_attention, BetterTransformer is only needed before that.
+    if not getattr(model, "_supports_sdpa", False):
+        from optimum.bettertransformer import BetterTransformer
+
+        model = BetterTransformer.transform(model)
+
+    # generate() calls the forward of the model for every decoding step. Compile
+    # it in place, wrapping the model in an OptimizedModule would not affect it.
+    # The number of rows and the length of the KV cache change with every batch
+    # and decoding step, so CUDA graphs ("reduce-overhead") would record a graph
+    # for each shape. The default mode compiles once with dynamic shapes.
+    model.forward = torch.compile(model.forward, fullgraph=False, dynamic=True)
+    return model
+
+
 def get_dataloader(
     accelerator: Accelerator,
-    filename: str,
-    tokenizer: PreTrainedTokenizerBase,
-    batch_size: int,
-    max_length: int,
+    dataset: DatasetReader,
+    num_workers: int = 0,
 ) -> DataLoader:
 
-    dataset = DatasetReader(filename, tokenizer, max_length)
-    if accelerator.distributed_type == DistributedType.TPU:
-        data_collator = DataCollatorForSeq2Seq(
-            tokenizer,
-            padding="max_length",
-            max_length=max_length,
-            label_pad_token_id=tokenizer.pad_token_id,
-            return_tensors="pt",
-        )
-    else:
-        data_collator = DataCollatorForSeq2Seq(
-            tokenizer,
-            padding=True,
-            label_pad_token_id=tokenizer.pad_token_id,
-            # max_length=max_length, No need to set max_length here, we already truncate in the preprocess function
-            pad_to_multiple_of=8,
-            return_tensors="pt",
-        )
+    # Index the file in the main process, the workers get a copy of the offsets.
+    dataset.load()
 
+    # prefetch_factor is kept low, every prefetched item is a whole padded batch.
+    worker_kwargs = (
+        {"prefetch_factor": 2, "persistent_workers": True} if num_workers > 0 else {}
+    )
     return DataLoader(
         dataset,
-        batch_size=batch_size,
-        collate_fn=data_collator,
+        batch_size=None,
+        num_workers=num_workers,
+        pin_memory=accelerator.device.type == "cuda",
+        **worker_kwargs,
     )
 
 
@@ -59,36 +405,101 @@ def main(
     precision: str = "32",
     max_length: int = 128,
     num_beams: int = 4,
+    num_workers: int = 0,
+    backend: str = "transformers",
+    ctranslate2_model_dir: str = None,
+    torch_compile: bool = False,
+    cache_size: int = 100000,
 ):
 
     if not os.path.exists(os.path.dirname(output_path)):
         os.makedirs(os.path.dirname(output_path))
 
     accelerator = Accelerator(
-        mixed_precision=precision if precision != "32" else "no", split_batches=True
+        mixed_precision=precision if precision in ["fp16", "bf16"] else "no",
+        split_batches=True,
     )
 
     print("Loading tokenizer...")
-    tokenizer = M2M100Tokenizer.from_pretrained(
-        pretrained_model_name_or_path=model_name, cache_dir=cache_dir
+    tokenizer = AutoTokenizer.from_pretrained(
+        pretrained_model_name_or_path=model_name, cache_dir=cache_dir, use_fast=True
     )
-    print("Loading model...")
-    model = M2M100ForConditionalGeneration.from_pretrained(
-        pretrained_model_name_or_path=model_name, cache_dir=cache_dir
+    if not tokenizer.is_fast:
+        print(
+            f"Warning: no fast tokenizer available for {model_name}, "
+            f"falling back to the slower {type(tokenizer).__name__}."
+        )
+    # Slow tokenizers (M2M100Tokenizer has no fast version) hold the GIL while
+    # decoding, extra copies would only cost loading time and memory.
+    num_decoder_shards = (
+        max(1, min(8, os.cpu_count() // 4)) if tokenizer.is_fast else 1
     )
-
-    model.eval()
-
-    print(f"Preparing data...\n")
-
-    if precision == "32":
-        model = model.float()
-    elif precision == "fp16":
-        model = model.half()
-    elif precision == "bf16":
-        model = model.bfloat16()
+    decoder = ShardedDecoder(
+        [tokenizer]
+        + [
+            AutoTokenizer.from_pretrained(
+                pretrained_model_name_or_path=model_name,
+                cache_dir=cache_dir,
+                use_fast=True,
+            )
+            for _ in range(num_decoder_shards - 1)
+        ]
+    )
+    print("Loading model...")
+    if backend == "ctranslate2":
+        if accelerator.num_processes > 1:
+            raise ValueError("The ctranslate2 backend only supports a single process")
+        model = load_ctranslate2_model(
+            model_name=model_name,
+            model_dir=(
+                ctranslate2_model_dir
+                if ctranslate2_model_dir is not None
+                else os.path.basename(os.path.normpath(model_name)) + "-ct2"
+            ),
+            precision=precision,
+            device=accelerator.device,
+        )
+        print(f"Preparing data...\n")
     else:
-        raise ValueError("Precision not supported. Supported values: 32, fp16, bf16")
+        if precision == "int8" and accelerator.device.type not in ["cuda", "cpu"]:
+            raise ValueError(
+                f"int8 precision is only supported on CUDA and CPU devices, "
+                f"not on {accelerator.device.type}"
+            )
+        if precision == "int8" and accelerator.device.type == "cuda":
+            # bitsandbytes sets the dtype and the device of the 8-bit weights.
+            model = M2M100ForConditionalGeneration.from_pretrained(
+                pretrained_model_name_or_path=model_name,
+                cache_dir=cache_dir,
+                quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+                device_map={"": accelerator.device},
+            )
+        else:
+            model = M2M100ForConditionalGeneration.from_pretrained(
+                pretrained_model_name_or_path=model_name, cache_dir=cache_dir
+            )
+
+        model.eval()
+
+        print(f"Preparing data...\n")
+
+        if precision == "32":
+            model = model.float()
+        elif precision == "fp16":
+            model = model.half()
+        elif precision == "bf16":
+            model = model.bfloat16()
+        elif precision == "int8":
+            # Dynamic quantization only runs on CPU, and int8 models are not
+            # moved by accelerator.prepare.
+            if accelerator.device.type == "cpu":
+                model = torch.ao.quantization.quantize_dynamic(
+                    model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+        else:
+            raise ValueError(
+                "Precision not supported. Supported values: 32, fp16, bf16, int8"
+            )
 
     tokenizer.src_lang = source_lang
     lang_code_to_idx = tokenizer.lang_code_to_id[target_lang]
@@ -99,60 +510,173 @@ def main(
         "num_return_sequences": 1,
     }
 
+    if torch_compile and backend == "transformers":
+        if precision == "int8":
+            raise ValueError("--compile is not supported with int8 precision")
+        print("Compiling model...")
+        model = compile_model(model).to(accelerator.device)
+        # Run one batch to trigger the compilation. Sizes of 0 and 1 are
+        # specialized by torch.compile, two rows keep the batch size dynamic.
+        dummy_input = torch.full(
+            (2, max_length), tokenizer.unk_token_id, device=accelerator.device
+        )
+        with torch.no_grad(), accelerator.autocast():
+            model.generate(
+                input_ids=dummy_input,
+                attention_mask=torch.ones_like(dummy_input),
+                forced_bos_token_id=lang_code_to_idx,
+                **gen_kwargs,
+            )
+
     total_lines: int = count_lines(sentences_path)
     print(
         f"We will translate {total_lines} lines. Initial batch size: {starting_batch_size}"
     )
 
+    # The dataset emits fully padded batches, each process reads its own share
+    # of every batch, so the DataLoader is not prepared by Accelerate.
+    dataset = DatasetReader(
+        sentences_path,
+        tokenizer,
+        max_length=max_length,
+        padding="max_length"
+        if accelerator.distributed_type == DistributedType.TPU
+        else True,
+        num_processes=accelerator.num_processes,
+        process_index=accelerator.process_index,
+    )
+
+    # Kept across the retries of the batch size finder.
+    cache = TranslationCache(cache_size) if cache_size > 0 else None
+
     @find_executable_batch_size(starting_batch_size=starting_batch_size)
     def inference(batch_size):
-        nonlocal model, tokenizer, sentences_path, max_length, output_path, lang_code_to_idx, gen_kwargs, total_lines, precision
-
-        print(f"Translating with batch size {batch_size}")
+        nonlocal model, tokenizer, decoder, dataset, max_length, output_path, lang_code_to_idx, gen_kwargs, total_lines, precision, num_workers, backend, cache
+
+        # Batches are packed up to a token budget instead of a number of
+        # sentences, so short sentences get larger batches.
+        max_tokens_per_batch = batch_size * max_length
+        print(
+            f"Translating with batch size {batch_size} "
+            f"({max_tokens_per_batch} tokens per batch)"
+        )
 
+        dataset.max_tokens_per_batch = max_tokens_per_batch
         data_loader = get_dataloader(
             accelerator=accelerator,
-            filename=sentences_path,
-            tokenizer=tokenizer,
-            batch_size=batch_size,
-            max_length=max_length,
+            dataset=dataset,
+            num_workers=num_workers,
         )
 
-        model, data_loader = accelerator.prepare(model, data_loader)
-
         with tqdm(
             total=total_lines, desc="Dataset translation", leave=True, ascii=True
-        ) as pbar, open(output_path, "w", encoding="utf-8") as output_file:
-            with torch.no_grad():
-                first_batch = True
-                for batch in data_loader:
-                    batch["input_ids"] = batch["input_ids"]
-                    batch["attention_mask"] = batch["attention_mask"]
-
-                    generated_tokens = accelerator.unwrap_model(model).generate(
+        ) as pbar, open(
+            output_path, "w", encoding="utf-8", newline="\n", buffering=1 << 20
+        ) as output_file, dataset.open_mmap() as mm:
+            writer = OrderedWriter(output_file)
+            # Empty lines are skipped by the dataset, their translation is empty.
+            empty_lines = dataset.empty_lines()
+            writer.add(empty_lines, [""] * len(empty_lines))
+            pbar.update(len(empty_lines))
+
+            if backend == "ctranslate2":
+                # The batches stay on the host, CTranslate2 moves them itself.
+                generate = partial(
+                    ctranslate2_generate,
+                    model,
+                    tokenizer,
+                    target_token=tokenizer.convert_ids_to_tokens(lang_code_to_idx),
+                    gen_kwargs=gen_kwargs,
+                )
+                max_generated_tokens = 0
+            else:
+                # Quantized models are already placed on their device.
+                if precision != "int8":
+                    model = accelerator.prepare(model)
+
+                def generate(batch):
+                    batch = {
+                        k: v.to(accelerator.device, non_blocking=True)
+                        for k, v in batch.items()
+                    }
+                    return accelerator.unwrap_model(model).generate(
                         **batch, forced_bos_token_id=lang_code_to_idx, **gen_kwargs
                     )
 
-                    generated_tokens = accelerator.pad_across_processes(
-                        generated_tokens, dim=1, pad_index=tokenizer.pad_token_id
-                    )
-
-                    generated_tokens = (
-                        accelerator.gather(generated_tokens).cpu().numpy()
-                    )
-
-                    tgt_text = tokenizer.batch_decode(
-                        generated_tokens, skip_special_tokens=True
-                    )
-                    if not first_batch:
-                        print(file=output_file)
+                # The most rows a batch can have is when every sentence has the
+                # smallest padded length, each row generates up to max_length
+                # tokens.
+                max_generated_tokens = (
+                    max_tokens_per_batch // dataset.padded_length(1) * max_length
+                )
+
+            with torch.no_grad(), AsyncPostprocessor(
+                decoder, writer, pbar, accelerator.device, max_generated_tokens
+            ) as postprocessor:
+                for step, batch in enumerate(data_loader, start=1):
+                    indices = batch.pop("indices")
+                    keys, cached = None, {}
+                    if cache is not None:
+                        keys = cache.keys(dataset, mm, indices)
+                        cached = cache.lookup(keys)
+                        if cached:
+                            uncached_rows = torch.tensor(
+                                [row for row in range(len(keys)) if row not in cached],
+                                dtype=torch.long,
+                            )
+                            batch = {k: v[uncached_rows] for k, v in batch.items()}
+
+                    generated_tokens = None
+                    if batch["input_ids"].shape[0] > 0:
+                        generated_tokens = generate(batch)
+
+                    merge = None
+                    # With a single process there is nothing to pad or gather.
+                    if accelerator.num_processes > 1:
+                        # The shares of all processes must have the same number
+                        # of rows, the cached rows are put back on the device.
+                        if cached:
+                            generated_tokens = fill_cached_rows(
+                                generated_tokens,
+                                cached,
+                                len(keys),
+                                tokenizer.pad_token_id,
+                                accelerator.device,
+                            )
+                        generated_tokens = accelerator.pad_across_processes(
+                            generated_tokens, dim=1, pad_index=tokenizer.pad_token_id
+                        )
+                        generated_tokens = accelerator.gather(generated_tokens)
+                        indices = accelerator.gather(indices.to(accelerator.device))
+                        indices = indices.cpu().numpy()
+                        # Every process stores the rows of all the processes,
+                        # the keys are computed from the gathered line indices.
+                        if cache is not None:
+                            merge = partial(
+                                cache.store,
+                                cache.keys(dataset, mm, indices),
+                                pad_token_id=tokenizer.pad_token_id,
+                            )
                     else:
-                        first_batch = False
-                    print("\n".join(tgt_text), file=output_file, end="")
-
-                    pbar.update(len(tgt_text))
+                        indices = indices.numpy()
+                        if cache is not None:
+                            merge = partial(
+                                cache.merge,
+                                keys,
+                                cached,
+                                pad_token_id=tokenizer.pad_token_id,
+                            )
+
+                    postprocessor.submit(generated_tokens, indices, merge)
+
+                    # Release the batch before the next one is loaded and
+                    # return cached blocks now and then to limit fragmentation.
+                    del batch, generated_tokens
+                    if step % 64 == 0 and accelerator.device.type == "cuda":
+                        torch.cuda.empty_cache()
 
     inference()
+    decoder.shutdown()
     print(f"Translation done.\n")
 
 
@@ -226,8 +750,51 @@ if __name__ == "__main__":
         "--precision",
         type=str,
         default="32",
-        choices=["bf16", "fp16", "32"],
-        help="Precision of the model. bf16, fp16 or 32.",
+        choices=["bf16", "fp16", "32", "int8"],
+        help="Precision of the model. bf16, fp16, 32 or int8. int8 quantizes the weights, "
+        "on GPU it requires `pip install bitsandbytes`.",
+    )
+
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=min(8, os.cpu_count()),
+        help="Number of DataLoader worker processes that read and tokenize the input "
+        "while the model is translating. Set to 0 to do it in the main process.",
+    )
+
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="transformers",
+        choices=["transformers", "ctranslate2"],
+        help="Inference backend. ctranslate2 requires `pip install ctranslate2` and "
+        "runs beam search in its optimized C++ runtime. Single process only.",
+    )
+
+    parser.add_argument(
+        "--ctranslate2_model_dir",
+        type=str,
+        default=None,
+        help="Directory of the CTranslate2 model. If it does not contain a converted "
+        "model, --model_name will be converted into it. "
+        "Defaults to <model_name>-ct2 in the current directory.",
+    )
+
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Fuse the attention kernels with BetterTransformer (`pip install optimum`, "
+        "only needed for old versions of transformers) and compile the model with "
+        "torch.compile. Requires Pytorch >= 2.0. Only for the transformers backend.",
+    )
+
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=100000,
+        help="Number of translations of repeated sentences to keep in memory, so each "
+        "sentence is only translated once. Set to 0 to disable the cache.",
     )
 
     args = parser.parse_args()
@@ -242,4 +809,9 @@ if __name__ == "__main__":
         cache_dir=args.cache_dir,
         num_beams=args.num_beams,
         precision=args.precision,
+        num_workers=args.num_workers,
+        backend=args.backend,
+        ctranslate2_model_dir=args.ctranslate2_model_dir,
+        torch_compile=args.compile,
+        cache_size=args.cache_size,
     )